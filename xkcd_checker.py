@@ -9,24 +9,86 @@ Project page: https://github.com/bryanhiestand/xkcd_checker
 See README.md for more information.
 """
 
-import base64
-import datetime
+import functools
 import logging
 import os
 import sys
-from ast import literal_eval
 
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+
+# orjson is optional; fall back to the stdlib parser if it is not installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 logging.basicConfig(level=20)
 
 xkcd_api_url = 'https://xkcd.com/info.0.json'
-history_file = 'xkcd_history.txt'
-comic_dir = 'comics'
+xkcd_comic_api_url = 'https://xkcd.com/{}/info.0.json'
+
+# State is kept next to the real script (symlinks resolved), whatever the
+# working directory (e.g. cron's)
+base_dir = os.path.dirname(os.path.realpath(__file__))
+history_db = os.path.join(base_dir, 'xkcd_history.db')
+# PRAGMA user_version of history_db once its schema exists and history_file is imported
+history_schema_version = 1
+# plain text history used before xkcd_history.db, imported once if present
+history_file = os.path.join(base_dir, 'xkcd_history.txt')
+etag_file = os.path.join(base_dir, '.xkcd_etag')
+comic_dir = os.path.join(base_dir, 'comics')
+
+# response headers remembered in etag_file -> conditional request header to send
+conditional_headers = {'ETag': 'If-None-Match', 'Last-Modified': 'If-Modified-Since'}
+
+# (connect, read) timeouts in seconds for requests to xkcd.com
+request_timeout = (5, 15)
+download_timeout = (5, 30)
+download_chunk_size = 64 * 1024
+
+# Maximum concurrent requests to xkcd.com when backfilling missed comics
+backfill_workers = 8
+
+# Share one connection pool between the json fetch and the image download so
+# the second request reuses the keep-alive TLS connection to xkcd.com.
+# Transient server errors are retried by urllib3 with exponential backoff.
+session = requests.Session()
+session.headers['User-Agent'] = 'xkcd_checker (+https://github.com/bryanhiestand/xkcd_checker)'
+http_adapter = HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=backfill_workers,
+    max_retries=Retry(total=2, backoff_factor=30, status_forcelist=[500, 502, 503, 504]),
+)
+session.mount('https://', http_adapter)
+session.mount('http://', http_adapter)
+
+# Body of the html email, filled in from one {'img', 'title'} mapping per comic
+email_html_template = """
+<html><body>
+<h1>
+<a href="%(img)s">%(title)s<img title="%(title)s" alt="%(title)s" style="display:block" src="%(img)s" /></a>
+</h1>
+<br>
+<br>
+Mailed by <a href="https://github.com/bryanhiestand/xkcd_checker">xkcd_checker</a>
+</body>
+"""
+
+
+class CheckFailed(Exception):
+    """A check for new comics could not complete. The cause has already been logged."""
+
 
 class Config(object):
     config_prefix = 'XKCD_'
+    # Poll no more often than once a minute, to be polite to xkcd.com
+    min_poll_interval = 60
+    true_values = {'1', 'true', 'yes', 'y', 'on', 't'}
+    false_values = {'0', 'false', 'no', 'n', 'off', 'f', ''}
 
     def __init__(self):
         # load env vars from .env
@@ -53,6 +115,13 @@ class Config(object):
         self.smtp_username = self.get_config_str('SMTP_USERNAME')
         self.smtp_password = self.get_config_str('SMTP_PASSWORD')
 
+        # How many comics missed since the last run to email before the latest one
+        self.backfill_limit = self.get_config_int('BACKFILL_LIMIT', default='10')
+
+        # Whether to keep running and poll xkcd every poll_interval seconds
+        self.daemon = self.get_config_bool('DAEMON', default='False')
+        self.poll_interval = self.get_config_int('POLL_INTERVAL', default='900', minimum=self.min_poll_interval)
+
         # Perform basic validation of config from .env
         if self.mail_attachment and not self.download:
             logging.error('XKCD_DOWNLOAD must be enabled before XKCD_MAIL_ATTACHMENT will work')
@@ -64,75 +133,223 @@ class Config(object):
     def get_config_str(self, item, default=None):
         return os.environ.get(f"{self.config_prefix}{item}", default)
 
-    def get_config_bool(self, item):
+    def get_config_int(self, item, default, minimum=0):
+        """Return an integer of at least minimum from environment variable config item."""
+        setting = self.get_config_str(item, default)
+        try:
+            value = int(setting)
+        except ValueError:
+            value = None
+
+        if value is None or value < minimum:
+            logging.error(f'{self.config_prefix}{item} must be a whole number of at least {minimum}, got {setting!r}')
+            sys.exit(1)
+
+        return value
+
+    def get_config_bool(self, item, default='True'):
         """Return a boolean from environment variable config item. Defaults to True."""
-        setting = os.environ.get(f"{self.config_prefix}{item}", 'True')
-        setting = setting.title()
-        return literal_eval(setting)
+        setting = os.environ.get(f"{self.config_prefix}{item}", default)
+        setting = setting.strip().lower()
+        if setting in self.true_values:
+            return True
+        if setting in self.false_values:
+            return False
+
+        logging.error(f'{self.config_prefix}{item} must be a boolean (true/false, yes/no, on/off, 1/0), got {setting!r}')
+        sys.exit(1)
+
+
+class SmtpConnection(object):
+    """SMTP connection that is opened on first use and kept open until closed."""
+    keepalive_interval = 240
+
+    def __init__(self, config):
+        self.config = config
+        self.smtp_object = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self):
+        """Return a connected, authenticated smtplib.SMTP object."""
+        import smtplib
+
+        if self.smtp_object is None:
+            smtp_object = smtplib.SMTP(self.config.smtp_server, self.config.smtp_port)
+            try:
+                smtp_object.ehlo()
+                if self.config.smtp_ttls:
+                    smtp_object.starttls()
+                    # server capabilities may change once the connection is encrypted
+                    smtp_object.ehlo()
+                if self.config.smtp_username or self.config.smtp_password:
+                    smtp_object.login(self.config.smtp_username, self.config.smtp_password)
+            except BaseException:
+                smtp_object.close()
+                raise
+            self.smtp_object = smtp_object
+
+        return self.smtp_object
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Send msg, reconnecting once if the server dropped a reused connection."""
+        import smtplib
+
+        reused = self.smtp_object is not None
+        try:
+            return self.get().sendmail(from_addr, to_addrs, msg)
+        except smtplib.SMTPServerDisconnected as e:
+            self.drop()
+            if not reused:
+                raise
+            logging.info(f'xkcd_checker.SmtpConnection.sendmail:SMTP connection was closed, reconnecting. Error: {e}')
+            return self.get().sendmail(from_addr, to_addrs, msg)
+
+    def drop(self):
+        """Forget the current connection without QUIT, e.g. after the server went away."""
+        if self.smtp_object is not None:
+            self.smtp_object.close()
+            self.smtp_object = None
+
+    def keepalive(self):
+        """Send NOOP on an open connection, dropping it if the server has gone away."""
+        if self.smtp_object is None:
+            return
+
+        import smtplib
+
+        try:
+            self.smtp_object.noop()
+        except (smtplib.SMTPException, OSError) as e:
+            logging.debug('xkcd_checker.SmtpConnection.keepalive:Dropping SMTP connection. Error: %s', e)
+            self.drop()
+
+    def close(self):
+        if self.smtp_object is None:
+            return
+
+        import smtplib
+
+        try:
+            self.smtp_object.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.drop()
+
+
+@functools.lru_cache(maxsize=1)
+def get_sendgrid_client(api_key):
+    """Return a SendGridAPIClient for api_key, shared by every send in the process."""
+    from sendgrid import SendGridAPIClient
+
+    return SendGridAPIClient(api_key)
 
 
 class Emailer(object):
-    def __init__(self, config, comic):
+    def __init__(self, config, comic, comic_filename=None):
         self.config = config
         self.comic = comic
-        self.comic_filename = get_local_filename(comic)
-
-        self.datetime_str = get_datetime_str(comic)
+        if comic_filename is not None:
+            # already computed by download_latest, skip recomputing it
+            self.comic_filename = comic_filename
         self.xkcd_title = comic['safe_title']
-        self.email_subject = f"New xkcd {comic['num']}: {self.xkcd_title} from {self.datetime_str}"
-        self.email_text = f"{self.xkcd_title}: {comic['img']}"
-        self.email_html = f"""
-<html><body>
-<h1>
-<a href="{comic['img']}">{self.xkcd_title}<img title="{self.xkcd_title}" alt="{self.xkcd_title}" style="display:block" src="{comic['img']}" /></a>
-</h1>
-<br>
-<br>
-Mailed by <a href="https://github.com/bryanhiestand/xkcd_checker">xkcd_checker</a>
-</body>
-"""
+        self._encoded_attachment = None
+        self._smtp_message = None
+
+    @functools.cached_property
+    def comic_filename(self):
+        return get_local_filename(self.comic)
+
+    @functools.cached_property
+    def datetime_str(self):
+        return get_datetime_str(self.comic)
+
+    @functools.cached_property
+    def comic_content_type(self):
+        """MIME type of the comic image, guessed from its file extension."""
+        import mimetypes
+
+        return mimetypes.guess_type(self.comic_filename)[0] or 'application/octet-stream'
+
+    @functools.cached_property
+    def email_subject(self):
+        return f"New xkcd {self.comic['num']}: {self.xkcd_title} from {self.datetime_str}"
+
+    @functools.cached_property
+    def email_text(self):
+        return f"{self.xkcd_title}: {self.comic['img']}"
+
+    @functools.cached_property
+    def email_html(self):
+        return email_html_template % {'img': self.comic['img'], 'title': self.xkcd_title}
+
+    def get_encoded_attachment(self):
+        """Return the downloaded comic as base64 text, encoding it only once."""
+        if self._encoded_attachment is None:
+            import base64
+            import mmap
+
+            new_comic_path = os.path.join(comic_dir, self.comic_filename)
+            with open(new_comic_path, 'rb') as attach_file:
+                # mmap cannot map an empty file, e.g. a zero-byte download
+                if os.fstat(attach_file.fileno()).st_size == 0:
+                    self._encoded_attachment = base64.b64encode(attach_file.read()).decode('ascii')
+                else:
+                    with mmap.mmap(attach_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        self._encoded_attachment = base64.b64encode(data).decode('ascii')
+
+        return self._encoded_attachment
 
     def mail_sendgrid(self):
-        from sendgrid import SendGridAPIClient
         from sendgrid.helpers.mail import (Attachment, Disposition, FileContent,
                                         FileName, FileType, Mail)
+        from concurrent.futures import ThreadPoolExecutor
 
         logging.info(f"Emailing {self.xkcd_title} via sendgrid")
 
-        client = SendGridAPIClient(self.config.sendgrid_api_key)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Read and encode the attachment while the client and message are built
+            if self.config.mail_attachment:
+                encoded_attachment = executor.submit(self.get_encoded_attachment)
 
-        message = Mail(
-            from_email=self.config.mail_from,
-            to_emails=self.config.mail_to,
-            subject=self.email_subject,
-            html_content=self.email_html
-        )
-        
-        if self.config.mail_attachment:
-            new_comic_path = os.path.join(comic_dir, self.comic_filename)
-            with open(new_comic_path, 'rb') as attach_file:
-                data = attach_file.read()
-                attach_file.close()
-            
-            encoded = base64.b64encode(data).decode()
-
-            attachedFile = Attachment(
-                FileContent(encoded),
-                FileName(self.comic_filename),
-                FileType('image/jpeg'),
-                Disposition('attachment')
+            client = get_sendgrid_client(self.config.sendgrid_api_key)
+
+            message = Mail(
+                from_email=self.config.mail_from,
+                to_emails=self.config.mail_to,
+                subject=self.email_subject,
+                html_content=self.email_html
             )
-            message.attachment = attachedFile
+
+            if self.config.mail_attachment:
+                attachedFile = Attachment(
+                    FileContent(encoded_attachment.result()),
+                    FileName(self.comic_filename),
+                    FileType(self.comic_content_type),
+                    Disposition('attachment')
+                )
+                message.attachment = attachedFile
 
         client.send(message)
 
-    def mail_smtp(self):
+    def build_smtp_message(self):
+        """Return the comic email as bytes ready for SMTP sendmail, building it only once."""
+        if self._smtp_message is None:
+            self._smtp_message = self._flatten_smtp_message()
+
+        return self._smtp_message
+
+    def _flatten_smtp_message(self):
         from email.mime.multipart import MIMEMultipart
         from email.mime.text import MIMEText
         from email.mime.image import MIMEImage
-        import smtplib
-
-        ttls = self.config.smtp_ttls
+        from email.mime.application import MIMEApplication
+        from email.generator import BytesGenerator
+        import io
 
         # Craft MIMEMultipart message
         msg = MIMEMultipart('alternative')
@@ -150,89 +367,194 @@ Mailed by <a href="https://github.com/bryanhiestand/xkcd_checker">xkcd_checker</
         msg.attach(part2)
 
         if self.config.mail_attachment:
-            comic_filename = get_local_filename(self.comic)
-            new_comic_path = os.path.join(comic_dir, comic_filename)
+            new_comic_path = os.path.join(comic_dir, self.comic_filename)
+            # Pass the subtype explicitly so MIMEImage does not sniff the image data
+            maintype, subtype = self.comic_content_type.split('/', 1)
+            mime_class = MIMEImage if maintype == 'image' else MIMEApplication
             with open(new_comic_path, 'rb') as attach_file:
-                attachment = MIMEImage(attach_file.read())
-                attachment.add_header('Content-Disposition', 'attachment', filename=comic_filename)
+                attachment = mime_class(attach_file.read(), _subtype=subtype)
+                attachment.add_header('Content-Disposition', 'attachment', filename=self.comic_filename)
                 msg.attach(attachment)
 
+        # Serialize straight to bytes; compat32 RFC 2047-encodes non-ASCII headers
+        msg_bytes = io.BytesIO()
+        BytesGenerator(msg_bytes, mangle_from_=False, policy=msg.policy).flatten(msg, linesep='\r\n')
+        return msg_bytes.getvalue()
+
+    def mail_smtp(self, connection=None):
+        """Email the comic via SMTP, reusing connection if given."""
+        msg_bytes = self.build_smtp_message()
+
         logging.info(f'Emailing {self.xkcd_title} via SMTP')
 
-        smtp_object = smtplib.SMTP(self.config.smtp_server, self.config.smtp_port)
-        smtp_object.ehlo()
-        if ttls:
-            smtp_object.starttls()
-        if self.config.smtp_username or self.config.smtp_password:
-            smtp_object.login(self.config.smtp_username, self.config.smtp_password)
+        if connection is None:
+            with SmtpConnection(self.config) as connection:
+                connection.sendmail(self.config.mail_from, self.config.mail_to, msg_bytes)
+        else:
+            connection.sendmail(self.config.mail_from, self.config.mail_to, msg_bytes)
+
 
-        smtp_object.sendmail(self.config.mail_from, self.config.mail_to, msg.as_string())
+def email_latest(config, comic, comic_filename=None, smtp_connection=None):
+    """Email comic using config.mail_method."""
+    emailer = Emailer(config, comic, comic_filename)
+    if config.mail_method == 'sendgrid':
+        return emailer.mail_sendgrid()
 
+    if config.mail_method == 'smtp':
+        return emailer.mail_smtp(smtp_connection)
 
-def check_xkcd():
-    """Check xkcd for the latest comic, return dict."""
-    retry_delay_minutes = 15
 
+def load_validators():
+    """Return the ETag/Last-Modified headers of the last fully processed xkcd json."""
+    validators = {}
     try:
-        r = requests.get(xkcd_api_url)
-        comic = r.json()
-    except requests.exceptions.RequestException as e:
-        logging.critical(f'xkcd_checker.check_xkcd:Unable to download json. Error: {e}')
-        logging.critical(f'sleeping {retry_delay_minutes} minute(s)')
+        with open(etag_file, 'rt') as f:
+            for line in f:
+                name, sep, value = line.strip().partition(': ')
+                if not sep:
+                    # files written before Last-Modified was stored hold a bare ETag
+                    name, value = 'ETag', name
+                if name in conditional_headers and value:
+                    validators[name] = value
+    except IOError:
+        pass
+
+    return validators
+
+
+def save_validators(validators):
+    """Persist the validators of the latest xkcd json for the next conditional request."""
+    if not validators:
+        return
 
-        import time
-        time.sleep(60*retry_delay_minutes)
-        try:
-            r = requests.get(xkcd_api_url)
-            comic = r.json()
-        except requests.exceptions.RequestException as e:
-            logging.critical(f'still unable to download after one retry. quitting. error {e}')
-            sys.exit(1)
+    try:
+        with open(etag_file, 'wt') as f:
+            for name, value in validators.items():
+                f.write(f'{name}: {value}\n')
+    except IOError as e:
+        logging.warning(f'xkcd_checker.save_validators:Unable to write {etag_file}. Error: {e}')
+
+
+def check_xkcd(validators=None):
+    """Check xkcd for the latest comic, return (dict, validators).
+
+    validators holds the ETag and Last-Modified response headers. If given and
+    the json has not changed since, return (None, validators).
+    """
+    validators = validators or {}
+    headers = {conditional_headers[name]: value for name, value in validators.items()}
+
+    try:
+        r = session.get(xkcd_api_url, headers=headers, timeout=request_timeout)
+        if r.status_code == 304:
+            logging.info('xkcd_checker.check_xkcd:xkcd json not modified. Exiting')
+            return None, validators
+        # info.0.json is UTF-8, so parse the raw bytes and skip charset detection
+        comic = json_loads(r.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.critical(f'xkcd_checker.check_xkcd:Unable to download json. Error: {e}')
+        raise CheckFailed(e) from e
     else:
-        logging.debug('Got xkcd json. Contents follow')
+        # lazy formatting: the payload is only rendered when debug logging is on
+        logging.debug('Got xkcd json: %r', comic)
 
-    for k, v in comic.items():
-        logging.debug(f'Latest XKCD Key: {k}')
-        logging.debug(f'Latest XKCD Value: {v}')
+    return comic, {name: r.headers[name] for name in conditional_headers if name in r.headers}
 
-    return comic
+
+@functools.lru_cache(maxsize=1)
+def get_history_db():
+    """Return the sqlite3 connection to history_db, creating it if needed.
+
+    On first use, comic numbers from a pre-sqlite history_file are imported.
+    """
+    import sqlite3
+
+    try:
+        # autocommit; each update_history insert is its own transaction
+        db = sqlite3.connect(history_db, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+
+        # Create the schema and import the old history in one transaction.
+        # user_version is only set once that commits, so a failed import
+        # leaves it at 0 and is retried on the next run.
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('CREATE TABLE IF NOT EXISTS seen(num INTEGER PRIMARY KEY)')
+            schema_version, = db.execute('PRAGMA user_version').fetchone()
+            if schema_version < history_schema_version:
+                if os.path.exists(history_file):
+                    with open(history_file, 'rb') as f:
+                        numbers = [(int(line),) for line in f if line.strip()]
+                    db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', numbers)
+                    logging.info(f'Imported {len(numbers)} comic(s) from {history_file} into {history_db}')
+                db.execute(f'PRAGMA user_version={history_schema_version}')
+    except (sqlite3.Error, IOError, ValueError) as e:
+        logging.critical(f'xkcd_checker.get_history_db:Unable to open or create {history_db}. Error: {e}')
+        logging.critical(f'xkcd_checker.get_history_db:Ensure the script directory {base_dir} is writable')
+        raise CheckFailed(e) from e
+
+    return db
+
+
+def get_last_seen():
+    """Return the newest comic number recorded in history_db, or None."""
+    # num is the primary key, so MAX() is an index lookup rather than a scan
+    last_seen, = get_history_db().execute('SELECT MAX(num) FROM seen').fetchone()
+    logging.debug('get_last_seen:last_seen=%s', last_seen)
+    return last_seen
 
 
 def is_downloaded(comic):
     """Check local datastore to see if latest xkcd is already downloaded."""
-    os.chdir(sys.path[0])
+    current_xkcd = int(comic['num'])
+    logging.debug('is_downloaded:current_xkcd %s', current_xkcd)
+
+    seen = get_history_db().execute('SELECT 1 FROM seen WHERE num=?', (current_xkcd,)).fetchone()
+    if seen is not None:
+        logging.info(f'xkcd_checker.is_downloaded:xkcd {current_xkcd} already downloaded. Exiting')
+        return True
+    else:
+        logging.info(f'xkcd_checker.is_downloaded:xkcd {current_xkcd} not found in history')
+        return False
 
-    current_xkcd = str(comic['num'])
-    logging.debug(f'is_downloaded:current_xkcd {current_xkcd}')
 
+def get_comic(number):
+    """Fetch the xkcd json for comic number, return dict or None if there is no such comic."""
     try:
-        # opening with mode a+ causes readlines to fail
-        with open(history_file, mode='rt') as f:
-            logging.debug(f'xkcd_checker.is_downloaded:Opened {history_file}')
-            for line in reversed(f.readlines()):
-                line = line.strip()
-                logging.debug(f'is_downloaded:line={line}')
-                if line == current_xkcd:
-                    logging.info(f'xkcd_checker.is_downloaded:xkcd {current_xkcd} already downloaded. Exiting')
-                    return True
-                else:
-                    pass
-            else:
-                logging.info(f'xkcd_checker.is_downloaded:xkcd {current_xkcd} not found in history')
-                return False
+        r = session.get(xkcd_comic_api_url.format(number), timeout=request_timeout)
+        if r.status_code == 404:
+            # e.g. xkcd 404 deliberately does not exist
+            logging.warning(f'xkcd_checker.get_comic:xkcd {number} not found, skipping')
+            return None
+        r.raise_for_status()
+        comic = json_loads(r.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.critical(f'xkcd_checker.get_comic:Unable to download json for xkcd {number}. Error: {e}')
+        raise CheckFailed(e) from e
+
+    logging.debug('Got xkcd %s json: %r', number, comic)
+    return comic
 
-    except IOError as e:
-        try:
-            # workaround for ISSUE1
-            with open(history_file, mode='w'):
-                pass
-        except IOError as e:
-            logging.critical(f'xkcd_checker.is_downloaded:Unable to open or create {history_file}. Error: {e}')
-            logging.critical('xkcd_checker.is_downloaded:Ensure current working directory is executable')
-            sys.exit(1)
-        else:
-            logging.debug(f'Created {history_file}')
-            return False
+
+def get_missed_comics(config, comic, executor):
+    """Return comics published since the last one in history, oldest first.
+
+    Ends with comic, the latest. At most config.backfill_limit earlier comics
+    are fetched, concurrently on executor.
+    """
+    last_seen = get_last_seen()
+    if last_seen is None:
+        # nothing to backfill against on the first run
+        return [comic]
+
+    latest = int(comic['num'])
+    missed = range(max(last_seen + 1, latest - config.backfill_limit), latest)
+    if missed:
+        logging.info(f'Backfilling {len(missed)} missed comic(s) since xkcd {last_seen}')
+
+    missed_comics = [c for c in executor.map(get_comic, missed) if c is not None]
+    return missed_comics + [comic]
 
 
 def get_local_filename(comic):
@@ -243,7 +565,9 @@ def get_local_filename(comic):
 
 
 def download_latest(config, comic):
-    """Download the latest xkcd image, log to history_file."""
+    """Download the latest xkcd image, return its local filename."""
+    import shutil
+
     comic_image_url = comic['img']
     comic_filename = get_local_filename(comic)
     download_file = os.path.join(comic_dir, comic_filename)
@@ -258,35 +582,41 @@ def download_latest(config, comic):
         os.makedirs(comic_dir, exist_ok=True)
     except IOError as e:
         logging.critical(f'xkcd_checker.download_latest:Unable to open or create {comic_dir}. Error: {e}')
-        sys.exit(1)
-
-    # Ensure history file is writable, or script will always re-download image
-    try:
-        with open(history_file, "at+"):
-            pass
-    except IOError as e:
-        logging.critical(f'xkcd_checker.download_latest:{history_file} not writable. Error: {e}')
-        sys.exit(1)
+        raise CheckFailed(e) from e
 
-    # Download the latest image as comic_filename
+    # Stream the latest image to disk as comic_filename in fixed-size chunks
     try:
-        with open(download_file, 'wb') as comic_file:
-            comic_image = requests.get(comic_image_url)
+        with session.get(comic_image_url, stream=True, timeout=download_timeout) as comic_image:
             comic_image.raise_for_status()
-            comic_file.write(comic_image.content)
+            comic_image.raw.decode_content = True
+            with open(download_file, 'wb') as comic_file:
+                shutil.copyfileobj(comic_image.raw, comic_file, length=download_chunk_size)
             logging.info(f'Downloaded latest comic {comic_filename}')
-    except requests.exceptions.RequestException as e:
-        logging.critical('xkcd_checker.download_latest:xkcd download failed')
-        sys.exit(1)
+    # reading response.raw directly raises urllib3 errors, not requests ones
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+        logging.critical(f'xkcd_checker.download_latest:xkcd download failed. Error: {e}')
+        remove_partial_download(download_file)
+        raise CheckFailed(e) from e
     except IOError as e:
-        logging.critical(f'xkcd_checker.download_latest:Unable to save {download_file} to {comic_dir}')
-        sys.exit(1)
+        logging.critical(f'xkcd_checker.download_latest:Unable to save {download_file} to {comic_dir}. Error: {e}')
+        remove_partial_download(download_file)
+        raise CheckFailed(e) from e
 
     return comic_filename
 
 
+def remove_partial_download(download_file):
+    """Remove a comic image left incomplete by an interrupted download."""
+    try:
+        os.remove(download_file)
+    except OSError:
+        pass
+
+
 def get_datetime_str(comic):
     """Return a pretty datetime string from latest comic data."""
+    import datetime
+
     year = int(comic['year'])
     month = int(comic['month'])
     day = int(comic['day'])
@@ -294,39 +624,108 @@ def get_datetime_str(comic):
     return comic_date.strftime("%a %d %b %y")
 
 def update_history(comic):
-    """Append comic number from comic to xkcd_history file."""
-    comic_number = str(comic['num'])
+    """Record comic number from comic in history_db.
+
+    Return True if it was newly recorded, so rollback_history may undo it.
+    """
+    import sqlite3
 
     try:
-        with open(history_file, "at") as file:
-            # Trailing newline for posix compliance
-            file.write(comic_number + '\n')
-    except IOError as e:
-        logging.critical(f'xkcd_checker.download_latest:{history_file} became unwritable. Error: {e}')
-        sys.exit(1)
+        cursor = get_history_db().execute('INSERT OR IGNORE INTO seen VALUES (?)', (int(comic['num']),))
+    except sqlite3.Error as e:
+        logging.critical(f'xkcd_checker.update_history:{history_db} not writable. Error: {e}')
+        raise CheckFailed(e) from e
 
-    return True
+    return cursor.rowcount == 1
 
 
-def main():
-    """Run functions sequentially to email and log latest xkcd comic."""
-    config = Config()
+def rollback_history(comic):
+    """Undo an update_history call for comic."""
+    import sqlite3
+
+    try:
+        get_history_db().execute('DELETE FROM seen WHERE num=?', (int(comic['num']),))
+    except sqlite3.Error as e:
+        logging.critical(f'xkcd_checker.rollback_history:Unable to roll back {history_db}. Error: {e}')
+
+
+def run_once(config, smtp_connection=None):
+    """Email and log the latest xkcd comic, plus any missed since the last run."""
+    comic, validators = check_xkcd(load_validators())
+    if comic is None:
+        return
 
-    comic = check_xkcd()
     if is_downloaded(comic):
+        save_validators(validators)
         return
 
-    download_latest(config, comic)
+    import contextlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    with contextlib.ExitStack() as stack:
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=backfill_workers))
+        # Send every comic in this run over one SMTP connection unless the
+        # caller keeps its own. It is only opened if an SMTP email is sent.
+        if smtp_connection is None and config.mail_method == 'smtp':
+            smtp_connection = stack.enter_context(SmtpConnection(config))
+
+        comics = get_missed_comics(config, comic, executor)
+        downloads = [executor.submit(download_latest, config, c) for c in comics]
+
+        # Email and record comics in order. Each history append (disk) overlaps
+        # with the downloads still in flight (network), so it is written
+        # speculatively and rolled back if that comic is not emailed.
+        for new_comic, download in zip(comics, downloads):
+            recorded = update_history(new_comic)
+            try:
+                comic_filename = download.result()
+                email_latest(config, new_comic, comic_filename, smtp_connection)
+            except BaseException:
+                if recorded:
+                    rollback_history(new_comic)
+                raise
+
+    save_validators(validators)
+    # TODO: create history object and methods instead
 
-    emailer = Emailer(config, comic)
-    if config.mail_method == 'sendgrid':
-        emailer.mail_sendgrid()
 
-    if config.mail_method == 'smtp':
-        emailer.mail_smtp()
+def run_forever(config):
+    """Poll xkcd every config.poll_interval seconds, reusing connections between polls."""
+    import time
 
-    update_history(comic)
-    # TODO: create history object and methods instead
+    logging.info(f'Polling xkcd every {config.poll_interval} seconds')
+
+    with SmtpConnection(config) as smtp_connection:
+        while True:
+            # A failed check is logged and retried at the next poll, keeping
+            # the warm HTTP and SMTP connections instead of exiting
+            try:
+                run_once(config, smtp_connection)
+            except CheckFailed:
+                logging.error(f'Check failed, retrying in {config.poll_interval} seconds')
+            except Exception:
+                logging.exception(f'Check failed, retrying in {config.poll_interval} seconds')
+                # the SMTP session may be mid-transaction; start a fresh one next time
+                smtp_connection.drop()
+
+            # Wake up periodically so an open SMTP connection is not dropped as idle
+            next_poll = time.monotonic() + config.poll_interval
+            while time.monotonic() < next_poll:
+                time.sleep(min(SmtpConnection.keepalive_interval, max(0, next_poll - time.monotonic())))
+                smtp_connection.keepalive()
+
+
+def main():
+    """Email and log latest xkcd comic, once or forever if XKCD_DAEMON is set."""
+    config = Config()
+
+    if config.daemon:
+        run_forever(config)
+    else:
+        try:
+            run_once(config)
+        except CheckFailed:
+            sys.exit(1)
 
 if __name__ == '__main__':
     main()